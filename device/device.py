@@ -1,23 +1,39 @@
 """
     Definition of device parameters for UPDI programming
 """
-import re
+import functools
+import sys
 
 # AVR Dx
-DEVICE_AVR_D_SERIES = set(["avr128da28", "avr128da32", "avr128da48", "avr128da64", "avr64da28", "avr64da32", "avr64da48", "avr64da64", "avr32da28", "avr32da32", "avr32da48", "avr128db28", "avr128db32", "avr128db48", "avr128db64", "avr64db28", "avr64db32", "avr64db48", "avr64db64", "avr32db28", "avr32db32", "avr32db48", "avr64dd14", "avr64dd20", "avr64dd28", "avr64dd32", "avr32dd14", "avr32dd20", "avr32dd28", "avr32dd32", "avr16dd14", "avr16dd20", "avr16dd28", "avr16dd32"])
+# (family, flash size in kB) -> available pin counts
+_AVR_D_PINS = {
+    ("da", 128): (28, 32, 48, 64),
+    ("da", 64): (28, 32, 48, 64),
+    ("da", 32): (28, 32, 48),
+    ("db", 128): (28, 32, 48, 64),
+    ("db", 64): (28, 32, 48, 64),
+    ("db", 32): (28, 32, 48),
+    ("dd", 64): (14, 20, 28, 32),
+    ("dd", 32): (14, 20, 28, 32),
+    ("dd", 16): (14, 20, 28, 32),
+}
+# Device name -> flash size in kB (e.g avr128da28 -> 128)
+_AVR_D_FLASH_KB = dict(("avr{}{}{}".format(size, family, pins), size)
+                       for (family, size), pin_counts in _AVR_D_PINS.items() for pins in pin_counts)
+DEVICE_AVR_D_SERIES = frozenset(_AVR_D_FLASH_KB)
 
 # megaAVR
-DEVICES_ATMEGA_48K = set(["atmega4808", "atmega4809"])
-DEVICES_ATMEGA_32K = set(["atmega3208", "atmega3209"])
-DEVICES_ATMEGA_16K = set(["atmega1608", "atmega1609"])
-DEVICES_ATMEGA_8K = set(["atmega808", "atmega809"])
+DEVICES_ATMEGA_48K = frozenset(("atmega4808", "atmega4809"))
+DEVICES_ATMEGA_32K = frozenset(("atmega3208", "atmega3209"))
+DEVICES_ATMEGA_16K = frozenset(("atmega1608", "atmega1609"))
+DEVICES_ATMEGA_8K = frozenset(("atmega808", "atmega809"))
 
 # tinyAVR
-DEVICES_ATTINY_32K = set(["attiny3216", "attiny3217"])
-DEVICES_ATTINY_16K = set(["attiny1604", "attiny1606", "attiny1607", "attiny1614", "attiny1616", "attiny1617"])
-DEVICES_ATTINY_8K = set(["attiny804", "attiny806", "attiny807", "attiny814", "attiny816", "attiny817"])
-DEVICES_ATTINY_4K = set(["attiny402", "attiny404", "attiny406", "attiny412", "attiny414", "attiny416", "attiny417"])
-DEVICES_ATTINY_2K = set(["attiny202", "attiny204", "attiny212", "attiny214"])
+DEVICES_ATTINY_32K = frozenset(("attiny3216", "attiny3217"))
+DEVICES_ATTINY_16K = frozenset(("attiny1604", "attiny1606", "attiny1607", "attiny1614", "attiny1616", "attiny1617"))
+DEVICES_ATTINY_8K = frozenset(("attiny804", "attiny806", "attiny807", "attiny814", "attiny816", "attiny817"))
+DEVICES_ATTINY_4K = frozenset(("attiny402", "attiny404", "attiny406", "attiny412", "attiny414", "attiny416", "attiny417"))
+DEVICES_ATTINY_2K = frozenset(("attiny202", "attiny204", "attiny212", "attiny214"))
 
 # Defaults
 DEFAULT_SYSCFG_ADDRESS = 0x0F00
@@ -26,114 +42,93 @@ DEFAULT_SIGROW_ADDRESS = 0x1100
 DEFAULT_FUSES_ADDRESS = 0x1280
 DEFAULT_USERROW_ADDRESS = 0x1300
 
+
+class UnknownDevice(ValueError):
+    """
+        Raised when a device name is not in the supported device list
+    """
+
+
+# Device name -> parameters, built once at import time
+_DEVICE_TABLE = {}
+
+
+def _add_devices(names, **params):
+    """
+        Registers a group of devices sharing the same parameters
+        Any address not given falls back to the defaults
+    """
+    entry = dict(syscfg_address=DEFAULT_SYSCFG_ADDRESS,
+                 nvmctrl_address=DEFAULT_NVMCTRL_ADDRESS,
+                 sigrow_address=DEFAULT_SIGROW_ADDRESS,
+                 fuses_address=DEFAULT_FUSES_ADDRESS,
+                 userrow_address=DEFAULT_USERROW_ADDRESS)
+    entry.update(params)
+    for name in names:
+        _DEVICE_TABLE[sys.intern(name)] = entry
+        # Also accept the name without at* prefix (e.g attiny202 -> tiny202)
+        # for legacy naming support
+        if name.startswith("at"):
+            _DEVICE_TABLE[sys.intern(name[2:])] = entry
+
+
+for _name in DEVICE_AVR_D_SERIES:
+    # Page size is irrelevant for writing since flash if word-oriented
+    # However since the 1-byte repeat-count is used for read, 256 is the max.
+    _add_devices((_name,), fuses_address=0x1050, userrow_address=0x1080, lock_address=0x1040,
+                 flash_start=0x800000, flash_size=_AVR_D_FLASH_KB[_name] * 1024,
+                 flash_pagesize=256)
+
+_add_devices(DEVICES_ATMEGA_48K, flash_start=0x4000, flash_size=48 * 1024, flash_pagesize=128)
+_add_devices(DEVICES_ATMEGA_32K, flash_start=0x4000, flash_size=32 * 1024, flash_pagesize=128)
+_add_devices(DEVICES_ATMEGA_16K, flash_start=0x4000, flash_size=16 * 1024, flash_pagesize=64)
+_add_devices(DEVICES_ATMEGA_8K, flash_start=0x4000, flash_size=8 * 1024, flash_pagesize=64)
+_add_devices(DEVICES_ATTINY_32K, flash_start=0x8000, flash_size=32 * 1024, flash_pagesize=128,
+             eeprom_start=0x1400, eeprom_size=256, eeprom_pagesize=64)
+_add_devices(DEVICES_ATTINY_16K, flash_start=0x8000, flash_size=16 * 1024, flash_pagesize=64,
+             eeprom_start=0x1400, eeprom_size=256, eeprom_pagesize=32)
+_add_devices(DEVICES_ATTINY_8K, flash_start=0x8000, flash_size=8 * 1024, flash_pagesize=64)
+_add_devices(DEVICES_ATTINY_4K, flash_start=0x8000, flash_size=4 * 1024, flash_pagesize=64)
+_add_devices(DEVICES_ATTINY_2K, flash_start=0x8000, flash_size=2 * 1024, flash_pagesize=64)
+
+
+# The supported device list never changes, so sort it once
+_SUPPORTED_DEVICES = tuple(sorted(_DEVICE_TABLE))
+
+
 class Device(object):  # pylint: disable=too-few-public-methods
     """
         Contains device specific information needed for programming
     """
 
+    __slots__ = ("syscfg_address", "nvmctrl_address", "sigrow_address", "fuses_address", "userrow_address",
+                 "lock_address", "flash_start", "flash_size", "flash_pagesize",
+                 "eeprom_start", "eeprom_size", "eeprom_pagesize")
+
     def __init__(self, device_name):
-        # Start with defaults
-        self.syscfg_address = DEFAULT_SYSCFG_ADDRESS
-        self.nvmctrl_address = DEFAULT_NVMCTRL_ADDRESS
-        self.sigrow_address = DEFAULT_SIGROW_ADDRESS
-        self.fuses_address = DEFAULT_FUSES_ADDRESS
-        self.userrow_address = DEFAULT_USERROW_ADDRESS
-        
-        # Add add at* prefix if not present
-        if(device_name.startswith("tiny") or device_name.startswith("mega")):
-            device_name = "at" + device_name
-
-        if device_name in DEVICE_AVR_D_SERIES:
-            self.fuses_address = 0x1050
-            self.userrow_address = 0x1080
-            self.lock_address = 0x1040
-            self.flash_start = 0x800000
-            self.flash_size = int(re.findall("\d+",device_name)[0]) * 1024
-            # Page size is irrelevant for writing since flash if word-oriented
-            # However since the 1-byte repeat-count is used for read, 256 is the max.
-            self.flash_pagesize = 256
-        elif device_name in DEVICES_ATMEGA_48K:
-            self.flash_start = 0x4000
-            self.flash_size = 48 * 1024
-            self.flash_pagesize = 128
-        elif device_name in DEVICES_ATMEGA_32K:
-            self.flash_start = 0x4000
-            self.flash_size = 32 * 1024
-            self.flash_pagesize = 128
-        elif device_name in DEVICES_ATMEGA_16K:
-            self.flash_start = 0x4000
-            self.flash_size = 16 * 1024
-            self.flash_pagesize = 64
-        elif device_name in DEVICES_ATMEGA_8K:
-            self.flash_start = 0x4000
-            self.flash_size = 8 * 1024
-            self.flash_pagesize = 64
-        elif device_name in DEVICES_ATTINY_32K:
-            self.flash_start = 0x8000
-            self.flash_size = 32 * 1024
-            self.flash_pagesize = 128
-            self.eeprom_start = 0x1400
-            self.eeprom_size = 256
-            self.eeprom_pagesize = 64
-        elif device_name in DEVICES_ATTINY_16K:
-            self.flash_start = 0x8000
-            self.flash_size = 16 * 1024
-            self.flash_pagesize = 64
-            self.eeprom_start = 0x1400
-            self.eeprom_size = 256
-            self.eeprom_pagesize = 32
-        elif device_name in DEVICES_ATTINY_8K:
-            self.flash_start = 0x8000
-            self.flash_size = 8 * 1024
-            self.flash_pagesize = 64
-        elif device_name in DEVICES_ATTINY_4K:
-            self.flash_start = 0x8000
-            self.flash_size = 4 * 1024
-            self.flash_pagesize = 64
-        elif device_name in DEVICES_ATTINY_2K:
-            self.flash_start = 0x8000
-            self.flash_size = 2 * 1024
-            self.flash_pagesize = 64
-        else:
-            raise Exception("Unknown device")
+        # Table keys are interned, so interning the name lets the lookup match by identity
+        device_name = sys.intern(device_name)
+
+        # Legacy names without at* prefix are table keys too
+        params = _DEVICE_TABLE.get(device_name)
+        if params is None:
+            raise UnknownDevice("Unknown device '{}'".format(device_name))
+
+        for attribute, value in params.items():
+            setattr(self, attribute, value)
 
     @staticmethod
     def get_supported_devices():
         """
             Query for device support list
-            :return: list of supported devices
+            :return: tuple of supported devices
         """
-        
-        # Remove at* prefix on all targets (e.g attiny202 -> tiny202)
-        # for legacy naming support
-        DEVICES_TINY_2K  = set([s[2:] for s in DEVICES_ATTINY_2K])
-        DEVICES_TINY_4K  = set([s[2:] for s in DEVICES_ATTINY_4K])
-        DEVICES_TINY_8K  = set([s[2:] for s in DEVICES_ATTINY_8K])
-        DEVICES_TINY_16K = set([s[2:] for s in DEVICES_ATTINY_16K])
-        DEVICES_TINY_32K = set([s[2:] for s in DEVICES_ATTINY_32K])
-        DEVICES_MEGA_8K  = set([s[2:] for s in DEVICES_ATMEGA_8K])
-        DEVICES_MEGA_16K = set([s[2:] for s in DEVICES_ATMEGA_16K])
-        DEVICES_MEGA_32K = set([s[2:] for s in DEVICES_ATMEGA_32K])
-        DEVICES_MEGA_48K = set([s[2:] for s in DEVICES_ATMEGA_48K])
-
-
-        return sorted(
-            DEVICES_ATTINY_2K  |
-            DEVICES_TINY_2K    |
-            DEVICES_ATTINY_4K  |
-            DEVICES_TINY_4K    |
-            DEVICES_ATTINY_8K  |
-            DEVICES_TINY_8K    |
-            DEVICES_ATTINY_16K |
-            DEVICES_TINY_16K   |
-            DEVICES_ATTINY_32K |
-            DEVICES_TINY_32K   |
-            DEVICES_ATMEGA_8K  |
-            DEVICES_MEGA_8K    |
-            DEVICES_ATMEGA_16K |
-            DEVICES_MEGA_16K   |
-            DEVICES_ATMEGA_32K |
-            DEVICES_MEGA_32K   |
-            DEVICES_ATMEGA_48K |
-            DEVICES_MEGA_48K   |
-            DEVICE_AVR_D_SERIES)
+        return _SUPPORTED_DEVICES
+
+
+@functools.lru_cache(maxsize=None)
+def get_device(device_name):
+    """
+        Returns the (shared) Device instance for a given device name
+    """
+    return Device(device_name)
@@ -16,10 +16,15 @@ class UpdiApplication(object):
     def __init__(self, comport, baud, device=None):
         self.datalink = UpdiDatalink(comport, baud)
         self.device = device
+        if device is not None:
+            # NVM controller registers used on every page
+            self._nvm_status_address = device.nvmctrl_address + constants.UPDI_NVMCTRL_STATUS
+            self._nvm_ctrla_address = device.nvmctrl_address + constants.UPDI_NVMCTRL_CTRLA
 
         self.logger = logging.getLogger("app")
+        self._sib_info = None
 
-        self.write_nvm = self.write_nvm_v0
+        self.write_nvm_pages = self.write_nvm_pages_v0
         self.chip_erase = self.chip_erase_v0
         self.write_fuse = self.write_fuse_v0
 
@@ -27,47 +32,60 @@ class UpdiApplication(object):
         """
             Reads out device information from various sources
         """
+        # The SIB never changes, so it is only read and parsed the first time
+        if self._sib_info is None:
+            self._sib_info = self._read_sib_info()
+        info = dict(self._sib_info)
+
+        if self.in_prog_mode():
+            if self.device is not None:
+                devid = self.read_data(self.device.sigrow_address, 3)
+                device_id_string = devid.hex().upper()
+                info['device_id'] = device_id_string
+                self.logger.info("Device ID = '%s'", device_id_string)
+
+                devrev = self.read_data(self.device.syscfg_address + 1, 1)
+                devrev_major = (int(devrev[0]) & 0xF0) >> 4
+                devrev_minor = int(devrev[0]) & 0x0F
+                device_rev_string = "{0:d}.{1:d}".format(devrev_major, devrev_minor)
+                info['device_rev'] = device_rev_string
+                self.logger.info("Device rev = '%s'", device_rev_string)
+        return info
+
+    def _read_sib_info(self):
+        """
+            Reads out and parses the System Information Block
+            Selects the NVM controller version to use from it
+        """
         info = {}
-        sib = bytearray(self.datalink.read_sib())
-        self.logger.info("SIB read out as: {}".format(sib))
+        # The SIB is plain ASCII: decode it once and slice the fields out of the string
+        sib = self.datalink.read_sib().decode("ascii", "replace")
+        self.logger.info("SIB read out as: %s", sib)
         
         # Parse fixed width fields according to spec
         family = sib[0:7].strip()
-        info['family'] = family.decode()
-        self.logger.info("Device family ID: '%s'", family.decode())
+        info['family'] = family
+        self.logger.info("Device family ID: '%s'", family)
 
         nvm = sib[8:11].strip()
-        self.logger.info("NVM interface: '%s'", nvm.decode())
-        info['nvm'] = nvm.decode()
-        if nvm.decode() == "P:2":
+        self.logger.info("NVM interface: '%s'", nvm)
+        info['nvm'] = nvm
+        if nvm == "P:2":
             self.logger.info("Using PDI v2")
-            self.write_nvm = self.write_nvm_v1
+            self.write_nvm_pages = self.write_nvm_pages_v1
             self.chip_erase = self.chip_erase_v1
             self.write_fuse = self.write_fuse_v1
             self.datalink.set_24bit_updi(True)
 
         ocd = sib[11:14].strip()
-        info['ocd'] = ocd.decode()
-        self.logger.info("Debug interface: '%s'", ocd.decode())
+        info['ocd'] = ocd
+        self.logger.info("Debug interface: '%s'", ocd)
 
         osc = sib[15:19].strip()
-        info['osc'] = osc.decode()
-        self.logger.info("PDI oscillator: '%sMHz'", osc.decode())
+        info['osc'] = osc
+        self.logger.info("PDI oscillator: '%sMHz'", osc)
 
-        self.logger.info("PDI revision = 0x{:X}".format(self.datalink.ldcs(constants.UPDI_CS_STATUSA) >> 4))
-        if self.in_prog_mode():
-            if self.device is not None:
-                devid = self.read_data(self.device.sigrow_address, 3)
-                device_id_string = "{0:02X}{1:02X}{2:02X}".format(devid[0], devid[1], devid[2])
-                info['device_id'] = device_id_string
-                self.logger.info("Device ID = '%s'", device_id_string)
-
-                devrev = self.read_data(self.device.syscfg_address + 1, 1)
-                devrev_major = (int(devrev[0]) & 0xF0) >> 4
-                devrev_minor = int(devrev[0]) & 0x0F
-                device_rev_string = "{0:d}.{1:d}".format(devrev_major, devrev_minor)
-                info['device_rev'] = device_rev_string
-                self.logger.info("Device rev = '%s'", device_rev_string)
+        self.logger.info("PDI revision = 0x%X", self.datalink.ldcs(constants.UPDI_CS_STATUSA) >> 4)
         return info
 
     def in_prog_mode(self):
@@ -78,6 +96,14 @@ class UpdiApplication(object):
             return True
         return False
 
+    def is_locked(self):
+        """
+            Checks whether the device is locked
+        """
+        if self.datalink.ldcs(constants.UPDI_ASI_SYS_STATUS) & (1 << constants.UPDI_ASI_SYS_STATUS_LOCKSTATUS):
+            return True
+        return False
+
     def wait_unlocked(self, timeout_ms):
         """
             Waits for the device to be unlocked.
@@ -86,8 +112,11 @@ class UpdiApplication(object):
 
         timeout = Timeout(timeout_ms)
 
+        ldcs = self.datalink.ldcs
+        locked_mask = 1 << constants.UPDI_ASI_SYS_STATUS_LOCKSTATUS
+        # Each status read is a full serial round trip, which already paces the polling
         while not timeout.expired():
-            if not self.datalink.ldcs(constants.UPDI_ASI_SYS_STATUS) & (1 << constants.UPDI_ASI_SYS_STATUS_LOCKSTATUS):
+            if not ldcs(constants.UPDI_ASI_SYS_STATUS) & locked_mask:
                 return True
 
         self.logger.info("Timeout waiting for device to unlock")
@@ -102,7 +131,7 @@ class UpdiApplication(object):
 
         # Check key status
         key_status = self.datalink.ldcs(constants.UPDI_ASI_KEY_STATUS)
-        self.logger.info("Key status = 0x{0:02X}".format(key_status))
+        self.logger.info("Key status = 0x%02X", key_status)
 
         if not key_status & (1 << constants.UPDI_ASI_KEY_STATUS_CHIPERASE):
             raise Exception("Key not accepted")
@@ -113,8 +142,7 @@ class UpdiApplication(object):
         self._progmode_key()
 
         # Toggle reset
-        self.reset(apply_reset=True)
-        self.reset(apply_reset=False)
+        self.toggle_reset()
 
         # And wait for unlock
         if not self.wait_unlocked(100):
@@ -136,7 +164,7 @@ class UpdiApplication(object):
 
         # Check key status
         key_status = self.datalink.ldcs(constants.UPDI_ASI_KEY_STATUS)
-        self.logger.info("Key status = 0x{0:02X}".format(key_status))
+        self.logger.info("Key status = 0x%02X", key_status)
 
         if not key_status & (1 << constants.UPDI_ASI_KEY_STATUS_NVMPROG):
             raise Exception("Key not accepted")
@@ -149,18 +177,16 @@ class UpdiApplication(object):
         self._progmode_key()
 
         # Toggle reset
-        self.reset(apply_reset=True)
-        self.reset(apply_reset=False)
+        self.toggle_reset()
 
         # Wait for NVMPROG flag
-        while True:
+        timeout = Timeout(1000)
+        while not timeout.expired():
             self.logger.info("Wait for NVMPROG")
             sys_status = self.datalink.ldcs(constants.UPDI_ASI_SYS_STATUS)
             if sys_status & (1 << constants.UPDI_ASI_SYS_STATUS_NVMPROG):
                 break
 
-            # TODO - add timeout
-        
         if not self.in_prog_mode():
             raise Exception("Failed to enter NVM programming mode")
 
@@ -172,8 +198,7 @@ class UpdiApplication(object):
             Disables UPDI which releases any keys enabled
         """
         self.logger.info("Leaving NVM programming mode")
-        self.reset(apply_reset=True)
-        self.reset(apply_reset=False)
+        self.toggle_reset()
         self.datalink.stcs(constants.UPDI_CS_CTRLB,
                            (1 << constants.UPDI_CTRLB_UPDIDIS_BIT) | (1 << constants.UPDI_CTRLB_CCDETDIS_BIT))
 
@@ -191,13 +216,28 @@ class UpdiApplication(object):
         else:
             self.logger.info("Release reset")
             self.datalink.stcs(constants.UPDI_ASI_RESET_REQ, 0x00)
-            while True:
-                # TODO - add timeout
-                self.logger.info("Wait for !reset")
-                sys_status = self.datalink.ldcs(constants.UPDI_ASI_SYS_STATUS)
-                if not sys_status & (1 << constants.UPDI_ASI_SYS_STATUS_RSTSYS):
-                    break
-                    #raise("Error releasing reset")
+            self._wait_reset_released()
+
+    def toggle_reset(self):
+        """
+            Applies and releases an UPDI reset condition, with both requests in one transfer
+        """
+        self.logger.info("Apply and release reset")
+        self.datalink.stcs_pair(constants.UPDI_ASI_RESET_REQ, constants.UPDI_RESET_REQ_VALUE, 0x00)
+        self._wait_reset_released()
+
+    def _wait_reset_released(self):
+        """
+            Waits for the device to come out of reset
+        """
+        timeout = Timeout(1000)
+        while not timeout.expired():
+            self.logger.info("Wait for !reset")
+            sys_status = self.datalink.ldcs(constants.UPDI_ASI_SYS_STATUS)
+            if not sys_status & (1 << constants.UPDI_ASI_SYS_STATUS_RSTSYS):
+                return
+
+        raise Exception("Timeout waiting for reset release")
 
     def wait_flash_ready(self):
         """
@@ -207,14 +247,18 @@ class UpdiApplication(object):
         timeout = Timeout(10000)  # 10 sec timeout, just to be sure
 
         self.logger.info("Wait flash ready")
+        ld = self.datalink.ld
+        status_address = self._nvm_status_address
+        error_mask = 1 << constants.UPDI_NVM_STATUS_WRITE_ERROR
+        busy_mask = (1 << constants.UPDI_NVM_STATUS_EEPROM_BUSY) | (1 << constants.UPDI_NVM_STATUS_FLASH_BUSY)
+        # Each status read is a full serial round trip, which already paces the polling
         while not timeout.expired():
-            status = self.datalink.ld(self.device.nvmctrl_address + constants.UPDI_NVMCTRL_STATUS)
-            if status & (1 << constants.UPDI_NVM_STATUS_WRITE_ERROR):
+            status = ld(status_address)
+            if status & error_mask:
                 self.logger.info("NVM error")
                 return False
 
-            if not status & ((1 << constants.UPDI_NVM_STATUS_EEPROM_BUSY) |
-                             (1 << constants.UPDI_NVM_STATUS_FLASH_BUSY)):
+            if not status & busy_mask:
                 return True
 
         self.logger.error("Wait flash ready timed out")
@@ -224,14 +268,17 @@ class UpdiApplication(object):
         """
             Executes an NVM COMMAND on the NVM CTRL
         """
-        self.logger.info("NVMCMD {:d} executing".format(command))
-        return self.datalink.st(self.device.nvmctrl_address + constants.UPDI_NVMCTRL_CTRLA, command)
+        self.logger.info("NVMCMD %d executing", command)
+        # No ack needed: errors show up in the NVM status, which the ready polls check
+        return self.datalink.st_noack(self._nvm_ctrla_address, command)
 
-    def chip_erase_v0(self):
+    def chip_erase_v0(self, wait=True):
         """
             Does a chip erase using the NVM controller
             Note that on locked devices this it not possible
             and the ERASE KEY has to be used instead
+            With wait=False the erase is left running, and the next
+            NVM operation's ready check waits for it
         """
         self.logger.info("Chip erase using NVM CTRL")
 
@@ -243,16 +290,18 @@ class UpdiApplication(object):
         self.execute_nvm_command(constants.UPDI_V0_NVMCTRL_CTRLA_CHIP_ERASE)
 
         # And wait for it
-        if not self.wait_flash_ready():
+        if wait and not self.wait_flash_ready():
             raise Exception("Timeout waiting for flash ready after erase")
 
         return True
 
-    def chip_erase_v1(self):
+    def chip_erase_v1(self, wait=True):
         """
             Does a chip erase using the NVM controller
             Note that on locked devices this it not possible
             and the ERASE KEY has to be used instead
+            With wait=False the erase is left running, and the next
+            NVM operation's ready check waits for it
         """
         self.logger.info("Chip erase using NVM CTRL")
 
@@ -264,7 +313,7 @@ class UpdiApplication(object):
         self.execute_nvm_command(constants.UPDI_V1_NVMCTRL_CTRLA_CHIP_ERASE)
 
         # And wait for it
-        if not self.wait_flash_ready():
+        if wait and not self.wait_flash_ready():
             raise Exception("Timeout waiting for flash ready after erase")
 
         return True
@@ -289,51 +338,34 @@ class UpdiApplication(object):
         """
             Writes a number of words to memory
         """
-        # Special-case of 1 word
-        if len(data) == 2:
-            value = data[0] + (data[1] << 8)
-            return self.datalink.st16(address, value)
-
         # Range check
         if len(data) > constants.UPDI_MAX_REPEAT_SIZE << 1:
             raise Exception("Invalid length")
 
-        # Store the address
-        self.datalink.st_ptr(address)
-
-        # Fire up the repeat
-        self.datalink.repeat(len(data) >> 1)
-        return self.datalink.st_ptr_inc16(data)
+        # Pointer, repeat and data go out as one transfer, with the words as little-endian bytes as given
+        # This is a single transfer even for one word, so no st16 special case is needed
+        return self.datalink.st_block(address, data, use_word_access=True)
 
     def write_data(self, address, data):
         """
             Writes a number of bytes to memory
         """
-        # Special case of 1 byte
+        # Special case of 1 byte: a plain store without acks is the shortest frame
         if len(data) == 1:
-            return self.datalink.st(address, data[0])
-        # Special case of 2 byte
-        elif len(data) == 2:
-            self.datalink.st(address, data[0])
-            return self.datalink.st(address + 1, data[1])
+            return self.datalink.st_noack(address, data[0])
 
         # Range check
         if len(data) > constants.UPDI_MAX_REPEAT_SIZE:
             raise Exception("Invalid length")
 
-        # Store the address
-        self.datalink.st_ptr(address)
+        # Pointer, repeat and data go out as one transfer
+        return self.datalink.st_block(address, data, use_word_access=False)
 
-        # Fire up the repeat
-        self.datalink.repeat(len(data))
-        return self.datalink.st_ptr_inc(data)
-
-    def write_nvm_v0(self, address, data, use_word_access=True):
+    def write_nvm_pages_v0(self, address, pages, use_word_access=True):
         """
-            Writes a page of data to NVM.
-            By default the PAGE_WRITE command is used, which
-            requires that the page is already erased.
-            By default word access is used (flash)
+            Writes consecutive pages of data to NVM.
+            The ready poll after each page write also serves as the
+            ready check before the next page.
         """
         nvm_command=constants.UPDI_V0_NVMCTRL_CTRLA_WRITE_PAGE
 
@@ -341,34 +373,46 @@ class UpdiApplication(object):
         if not self.wait_flash_ready():
             raise Exception("Timeout waiting for flash ready before page buffer clear ")
 
-        # Clear the page buffer
-        self.logger.info("Clear page buffer")
-        self.execute_nvm_command(constants.UPDI_V0_NVMCTRL_CTRLA_PAGE_BUFFER_CLR)
+        write_page = self._write_page_v0
+        wait_flash_ready = self.wait_flash_ready
+        for page in pages:
+            self.logger.debug("Writing page at 0x%04X", address)
+            write_page(address, page, nvm_command, use_word_access)
 
-        # Wait for NVM controller to be ready
-        if not self.wait_flash_ready():
-            raise Exception("Timeout waiting for flash ready after page buffer clear")
+            # Wait for NVM controller to be ready again
+            if not wait_flash_ready():
+                raise Exception("Timeout waiting for flash ready after page write ")
+            address += len(page)
 
-        # Load the page buffer by writing directly to location
-        if use_word_access:
-            self.write_data_words(address, data)
-        else:
-            self.write_data(address, data)
-
-        # Write the page to NVM, maybe erase first
-        self.logger.info("Committing page")
-        self.execute_nvm_command(nvm_command)
+    def _write_page_v0(self, address, data, nvm_command, use_word_access):
+        """
+            Clears the page buffer, loads it and commits it to NVM.
+            The NVM controller must be ready.
+        """
+        # Range check
+        max_size = constants.UPDI_MAX_REPEAT_SIZE << 1 if use_word_access else constants.UPDI_MAX_REPEAT_SIZE
+        if len(data) > max_size:
+            raise Exception("Invalid length")
 
-        # Wait for NVM controller to be ready again
-        if not self.wait_flash_ready():
-            raise Exception("Timeout waiting for flash ready after page write ")
+        # Clear the page buffer, load it by writing directly to location and commit it, all as one transfer
+        # The buffer clear completes long before the data is on the wire, so no ready poll is needed
+        self.logger.debug("Clear page buffer, load and commit page")
+        self.datalink.st_block(address, data, use_word_access,
+                               before=[(self._nvm_ctrla_address, constants.UPDI_V0_NVMCTRL_CTRLA_PAGE_BUFFER_CLR)],
+                               after=[(self._nvm_ctrla_address, nvm_command)])
 
-    def write_nvm_v1(self, address, data):
+    def write_nvm_pages_v1(self, address, pages, use_word_access=True):
         """
-            Writes data to NVM.
-            This version of the NVM block has no page buffer, so words are written directly.
+            Writes consecutive pages of data to NVM.
+            The write command is left in place for all pages, and only
+            removed from the NVM controller once the last page is done.
         """
-        nvm_command=constants.UPDI_V1_NVMCTRL_CTRLA_FLASH_WRITE
+        if use_word_access:
+            nvm_command = constants.UPDI_V1_NVMCTRL_CTRLA_FLASH_WRITE
+            write = self.write_data_words
+        else:
+            nvm_command = constants.UPDI_V1_NVMCTRL_CTRLA_EEPROM_ERASE_WRITE
+            write = self.write_data
 
         # Check that NVM controller is ready
         if not self.wait_flash_ready():
@@ -378,12 +422,16 @@ class UpdiApplication(object):
         self.logger.info("NVM write command")
         self.execute_nvm_command(nvm_command)
 
-        # Write the data
-        self.write_data_words(address, data)
+        wait_flash_ready = self.wait_flash_ready
+        for page in pages:
+            self.logger.debug("Writing page at 0x%04X", address)
+            # Write the data
+            write(address, page)
 
-        # Wait for NVM controller to be ready again
-        if not self.wait_flash_ready():
-            raise Exception("Timeout waiting for NVM ready after data write")
+            # Wait for NVM controller to be ready again
+            if not wait_flash_ready():
+                raise Exception("Timeout waiting for NVM ready after data write")
+            address += len(page)
 
         # Remove command from NVM controller
         self.logger.info("Clear NVM command")
@@ -425,67 +473,59 @@ class UpdiApplication(object):
         if not self.wait_flash_ready():
             raise Exception("Flash not ready for fuse setting")
 
-        fuse_data = value
         fuse_address = self.device.fuses_address + fusenum
 
-        address = self.device.nvmctrl_address + constants.UPDI_NVMCTRL_ADDRL
-        data = [fuse_address & 0xff]
-        self.write_data(address, data)
-
-        address = self.device.nvmctrl_address + constants.UPDI_NVMCTRL_ADDRH
-        data = [fuse_address >> 8]
-        self.write_data(address, data)
-
-        address = self.device.nvmctrl_address + constants.UPDI_NVMCTRL_DATAL
-        self.write_data(address, fuse_data)
-
-        address = self.device.nvmctrl_address + constants.UPDI_NVMCTRL_CTRLA
-        data = [constants.UPDI_V0_NVMCTRL_CTRLA_WRITE_FUSE]
-
-        self.write_data(address, data)
+        # DATAL, DATAH, ADDRL and ADDRH are consecutive registers, so they are loaded as one block
+        # and the fuse write command follows in the same transfer
+        data = bytes([value[0], 0, fuse_address & 0xff, fuse_address >> 8])
+        self.datalink.st_block(self.device.nvmctrl_address + constants.UPDI_NVMCTRL_DATAL, data,
+                               use_word_access=False,
+                               after=[(self._nvm_ctrla_address, constants.UPDI_V0_NVMCTRL_CTRLA_WRITE_FUSE)])
 
     def write_fuse_v1(self, fusenum, value):
         """
             Writes one fuse value
             DA fuses are EEPROM-based
         """
-        return self.write_eeprom_v1(fusenum, value)
+        return self.write_eeprom_v1(self.device.fuses_address + fusenum, value)
 
     def read_data(self, address, size):
         """
             Reads a number of bytes of data from UPDI
         """
-        self.logger.info("Reading {0:d} bytes from 0x{1:04X}".format(size, address))
+        self.logger.info("Reading %d bytes from 0x%04X", size, address)
         # Range check
         if size > constants.UPDI_MAX_REPEAT_SIZE:
             raise Exception("Can't read that many bytes in one go")
 
-        # Store the address
-        self.datalink.st_ptr(address)
+        # Pointer, repeat and read in one transfer
+        return self.datalink.ld_block(address, size)
 
-        # Fire up the repeat
-        if size > 1:
-            self.datalink.repeat(size)
+    def read_data_into(self, address, buffer):
+        """
+            Reads enough bytes of data from UPDI to fill a buffer
+            Returns the number of bytes received
+        """
+        size = len(buffer)
+        self.logger.info("Reading %d bytes from 0x%04X", size, address)
+        # Range check
+        if size > constants.UPDI_MAX_REPEAT_SIZE:
+            raise Exception("Can't read that many bytes in one go")
 
-        # Do the read(s)
-        return self.datalink.ld_ptr_inc(size)
+        # Pointer, repeat and read in one transfer
+        return self.datalink.ld_block_into(address, buffer)
 
-    def read_data_words(self, address, words):
+    def read_data_words_into(self, address, buffer):
         """
-            Reads a number of words of data from UPDI
+            Reads enough words of data from UPDI to fill a buffer
+            Returns the number of bytes received
         """
-        self.logger.info("Reading {0:d} words from 0x{1:04X}".format(words, address))
+        words = len(buffer) >> 1
+        self.logger.info("Reading %d words from 0x%04X", words, address)
 
         # Range check
         if words > constants.UPDI_MAX_REPEAT_SIZE:
             raise Exception("Can't read that many words in one go")
 
-        # Store the address
-        self.datalink.st_ptr(address)
-
-        # Fire up the repeat
-        if words > 1:
-            self.datalink.repeat(words)
-
-        # Do the read
-        return self.datalink.ld_ptr_inc16(words)
+        # Pointer, repeat and read in one transfer
+        return self.datalink.ld_block_into(address, buffer, use_word_access=True)
@@ -77,6 +77,8 @@ UPDI_ASI_SYS_STATUS_LOCKSTATUS = 0
 
 UPDI_RESET_REQ_VALUE = 0x59
 
+UPDI_ASI_CTRLA_UPDICLKSEL_16M = 0x01
+
 # FLASH CONTROLLER
 UPDI_NVMCTRL_CTRLA = 0x00
 UPDI_NVMCTRL_CTRLB = 0x01
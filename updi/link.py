@@ -1,12 +1,65 @@
 """
     Link layer in UPDI protocol stack
 """
+import functools
 import logging
 import time
 
 from updi.physical import UpdiPhysical
 import updi.constants as constants
 
+# Fixed frame headers (SYNC + opcode), built once
+_HDR_LDS16_8 = bytes([constants.UPDI_PHY_SYNC,
+                      constants.UPDI_LDS | constants.UPDI_ADDRESS_16 | constants.UPDI_DATA_8])
+_HDR_LDS16_16 = bytes([constants.UPDI_PHY_SYNC,
+                       constants.UPDI_LDS | constants.UPDI_ADDRESS_16 | constants.UPDI_DATA_16])
+_HDR_STS16_8 = bytes([constants.UPDI_PHY_SYNC,
+                      constants.UPDI_STS | constants.UPDI_ADDRESS_16 | constants.UPDI_DATA_8])
+_HDR_STS16_16 = bytes([constants.UPDI_PHY_SYNC,
+                       constants.UPDI_STS | constants.UPDI_ADDRESS_16 | constants.UPDI_DATA_16])
+_HDR_LD_PTRINC_8 = bytes([constants.UPDI_PHY_SYNC,
+                          constants.UPDI_LD | constants.UPDI_PTR_INC | constants.UPDI_DATA_8])
+_HDR_LD_PTRINC_16 = bytes([constants.UPDI_PHY_SYNC,
+                           constants.UPDI_LD | constants.UPDI_PTR_INC | constants.UPDI_DATA_16])
+_HDR_ST_PTR_ADDR_16 = bytes([constants.UPDI_PHY_SYNC,
+                             constants.UPDI_ST | constants.UPDI_PTR_ADDRESS | constants.UPDI_DATA_16])
+_HDR_ST_PTRINC_8 = bytes([constants.UPDI_PHY_SYNC,
+                          constants.UPDI_ST | constants.UPDI_PTR_INC | constants.UPDI_DATA_8])
+_HDR_ST_PTRINC_16 = bytes([constants.UPDI_PHY_SYNC,
+                           constants.UPDI_ST | constants.UPDI_PTR_INC | constants.UPDI_DATA_16])
+_HDR_LDS24_8 = bytes([constants.UPDI_PHY_SYNC,
+                      constants.UPDI_LDS | constants.UPDI_ADDRESS_24 | constants.UPDI_DATA_8])
+_HDR_LDS24_16 = bytes([constants.UPDI_PHY_SYNC,
+                       constants.UPDI_LDS | constants.UPDI_ADDRESS_24 | constants.UPDI_DATA_16])
+_HDR_STS24_8 = bytes([constants.UPDI_PHY_SYNC,
+                      constants.UPDI_STS | constants.UPDI_ADDRESS_24 | constants.UPDI_DATA_8])
+_HDR_STS24_16 = bytes([constants.UPDI_PHY_SYNC,
+                       constants.UPDI_STS | constants.UPDI_ADDRESS_24 | constants.UPDI_DATA_16])
+_HDR_ST_PTR_ADDR_24 = bytes([constants.UPDI_PHY_SYNC,
+                             constants.UPDI_ST | constants.UPDI_PTR_ADDRESS | constants.UPDI_DATA_24])
+
+# CTRLA settings around streamed writes: inter-byte delay on, with and without RSD (response signature disable)
+_CTRLA_ACKON = 1 << constants.UPDI_CTRLA_IBDLY_BIT
+_CTRLA_ACKOFF = _CTRLA_ACKON | (1 << constants.UPDI_CTRLA_RSD_BIT)
+_FRAME_ACKON = bytes([constants.UPDI_PHY_SYNC, constants.UPDI_STCS | constants.UPDI_CS_CTRLA, _CTRLA_ACKON])
+_FRAME_ACKOFF = bytes([constants.UPDI_PHY_SYNC, constants.UPDI_STCS | constants.UPDI_CS_CTRLA, _CTRLA_ACKOFF])
+
+# Read timeout while probing a new baud (seconds): a good answer comes back within a USB frame or two
+_BAUD_PROBE_TIMEOUT = 0.05
+
+
+@functools.lru_cache(maxsize=None)
+def _repeat_frame(repeats):
+    """
+        Builds the REPEAT frame for a repeat count
+        Only a few counts (the device page sizes) are ever used, so each frame is built once
+    """
+    # A count of 0 would encode as 0xFF, i.e. 256 repeats
+    if not 1 <= repeats <= constants.UPDI_MAX_REPEAT_SIZE:
+        raise Exception("Invalid repeat count!")
+    return bytes([constants.UPDI_PHY_SYNC, constants.UPDI_REPEAT | constants.UPDI_REPEAT_BYTE,
+                  (repeats - 1) & 0xFF])
+
 
 class UpdiDatalink(object):
     """
@@ -31,6 +84,45 @@ class UpdiDatalink(object):
             if not self.check():
                 raise Exception("UPDI initialisation failed")
 
+    def try_baud(self, bauds):
+        """
+            Switches to the first of the given bauds that the device answers at correctly
+            Stays at the current baud if none of them work
+            Returns the baud in use
+        """
+        start_baud = self.updi_phy.baud
+        # The default 4 MHz UPDI clock is only good for about 225 kbaud, so run UPDI at 16 MHz while probing
+        start_clock = self.ldcs(constants.UPDI_ASI_CTRLA)
+        # The datasheets only recommend a UPDI clock above 4 MHz with BOD at its highest level,
+        # and page writes are not acknowledged, so make the change visible
+        self.logger.warning("Raising the UPDI clock to 16 MHz to probe faster bauds: "
+                            "the datasheets only recommend this with BOD at its highest level")
+        self.stcs(constants.UPDI_ASI_CTRLA, constants.UPDI_ASI_CTRLA_UPDICLKSEL_16M)
+        # Any answer at a new baud must match this one. The whole 16 byte SIB is compared,
+        # so a link which only garbles some bytes is not taken as a pass
+        reference = self.read_sib()
+        for baud in bauds:
+            if baud == start_baud:
+                break
+            self.updi_phy.set_baud(baud)
+            # A device that can't keep up doesn't answer at all, so don't wait the full port timeout for it
+            previous_timeout = self.updi_phy.set_timeout(_BAUD_PROBE_TIMEOUT)
+            try:
+                sib = self.read_sib()
+            finally:
+                self.updi_phy.set_timeout(previous_timeout)
+            if reference and sib == reference:
+                self.logger.info("Using %d baud", baud)
+                return baud
+            # Get UPDI back into a known state at the starting baud before going on
+            self.updi_phy.set_baud(start_baud)
+            self.updi_phy.send_double_break()
+            self.init()
+            self.stcs(constants.UPDI_ASI_CTRLA, constants.UPDI_ASI_CTRLA_UPDICLKSEL_16M)
+        # Nothing faster works, so the UPDI clock goes back to what it was too
+        self.stcs(constants.UPDI_ASI_CTRLA, start_clock)
+        return start_baud
+
     def set_24bit_updi(self, mode):
         self.logger.info("Using 24-bit updi")
         self.use24bit = mode
@@ -40,7 +132,7 @@ class UpdiDatalink(object):
             Set the inter-byte delay bit and disable collision detection
         """
         self.stcs(constants.UPDI_CS_CTRLB, 1 << constants.UPDI_CTRLB_CCDETDIS_BIT)
-        self.stcs(constants.UPDI_CS_CTRLA, 1 << constants.UPDI_CTRLA_IBDLY_BIT)
+        self.stcs(constants.UPDI_CS_CTRLA, _CTRLA_ACKON)
 
     def check(self):
         """
@@ -56,8 +148,8 @@ class UpdiDatalink(object):
         """
             Load data from Control/Status space
         """
-        self.logger.info("LDCS from 0x{0:02X}".format(address))
-        self.updi_phy.send([constants.UPDI_PHY_SYNC, constants.UPDI_LDCS | (address & 0x0F)])
+        self.logger.info("LDCS from 0x%02X", address)
+        self.updi_phy.send(bytes([constants.UPDI_PHY_SYNC, constants.UPDI_LDCS | (address & 0x0F)]))
         response = self.updi_phy.receive(1)
         if len(response) != 1:
             # Todo - flag error
@@ -68,57 +160,54 @@ class UpdiDatalink(object):
         """
             Store a value to Control/Status space
         """
-        self.logger.info("STCS 0x{0:02X} to 0x{1:02X}".format(value, address))
-        self.updi_phy.send([constants.UPDI_PHY_SYNC, constants.UPDI_STCS | (address & 0x0F), value])
+        self.logger.info("STCS 0x%02X to 0x%02X", value, address)
+        self.updi_phy.send(bytes([constants.UPDI_PHY_SYNC, constants.UPDI_STCS | (address & 0x0F), value]))
+
+    def stcs_pair(self, address, first, second):
+        """
+            Store two values in turn to the same Control/Status register, in one transfer
+        """
+        self.logger.info("STCS 0x%02X then 0x%02X to 0x%02X", first, second, address)
+        opcode = constants.UPDI_STCS | (address & 0x0F)
+        self.updi_phy.send(bytes([constants.UPDI_PHY_SYNC, opcode, first,
+                                  constants.UPDI_PHY_SYNC, opcode, second]))
 
     def ld(self, address):
         """
             Load a single byte direct from a 16/24-bit address
         """
-        self.logger.info("LD from 0x{0:06X}".format(address))
+        self.logger.info("LD from 0x%06X", address)
         if self.use24bit:
-            self.updi_phy.send(
-                [constants.UPDI_PHY_SYNC, constants.UPDI_LDS | constants.UPDI_ADDRESS_24 | constants.UPDI_DATA_8,
-                 address & 0xFF, (address >> 8) & 0xFF, (address >> 16) & 0xFF])
+            self.updi_phy.send(_HDR_LDS24_8 + address.to_bytes(3, "little"))
         else:
-            self.updi_phy.send(
-                [constants.UPDI_PHY_SYNC, constants.UPDI_LDS | constants.UPDI_ADDRESS_16 | constants.UPDI_DATA_8,
-                 address & 0xFF, (address >> 8) & 0xFF])
+            self.updi_phy.send(_HDR_LDS16_8 + address.to_bytes(2, "little"))
         return self.updi_phy.receive(1)[0]
 
     def ld16(self, address):
         """
             Load a 16-bit word directly from a 16/24-bit address
         """
-        self.logger.info("LD from 0x{0:06X}".format(address))
+        self.logger.info("LD from 0x%06X", address)
         if self.use24bit:
-            self.updi_phy.send(
-                [constants.UPDI_PHY_SYNC, constants.UPDI_LDS | constants.UPDI_ADDRESS_24 | constants.UPDI_DATA_16,
-                address & 0xFF, (address >> 8) & 0xFF, (address >> 16) & 0xFF])
+            self.updi_phy.send(_HDR_LDS24_16 + address.to_bytes(3, "little"))
         else:
-            self.updi_phy.send(
-                [constants.UPDI_PHY_SYNC, constants.UPDI_LDS | constants.UPDI_ADDRESS_16 | constants.UPDI_DATA_16,
-                address & 0xFF, (address >> 8) & 0xFF])
+            self.updi_phy.send(_HDR_LDS16_16 + address.to_bytes(2, "little"))
         return self.updi_phy.receive(2)
 
     def st(self, address, value):
         """
             Store a single byte value directly to a 16/24-bit address
         """
-        self.logger.info("ST to 0x{0:06X}".format(address))
+        self.logger.info("ST to 0x%06X", address)
         if self.use24bit:
-            self.updi_phy.send(
-                [constants.UPDI_PHY_SYNC, constants.UPDI_STS | constants.UPDI_ADDRESS_24 | constants.UPDI_DATA_8,
-                 address & 0xFF, (address >> 8) & 0xFF, (address >> 16) & 0xFF])
+            self.updi_phy.send(_HDR_STS24_8 + address.to_bytes(3, "little"))
         else:
-            self.updi_phy.send(
-                [constants.UPDI_PHY_SYNC, constants.UPDI_STS | constants.UPDI_ADDRESS_16 | constants.UPDI_DATA_8,
-                 address & 0xFF, (address >> 8) & 0xFF])
+            self.updi_phy.send(_HDR_STS16_8 + address.to_bytes(2, "little"))
         response = self.updi_phy.receive(1)
         if len(response) != 1 or response[0] != constants.UPDI_PHY_ACK:
             raise Exception("Error with st")
 
-        self.updi_phy.send([value & 0xFF])
+        self.updi_phy.send(bytes([value & 0xFF]))
         response = self.updi_phy.receive(1)
         if len(response) != 1 or response[0] != constants.UPDI_PHY_ACK:
             raise Exception("Error with st")
@@ -127,108 +216,113 @@ class UpdiDatalink(object):
         """
             Store a 16-bit word value directly to a 16/24-bit address
         """
-        self.logger.info("ST to 0x{0:06X}".format(address))
+        self.logger.info("ST to 0x%06X", address)
         if self.use24bit:
-            self.updi_phy.send(
-                [constants.UPDI_PHY_SYNC, constants.UPDI_STS | constants.UPDI_ADDRESS_24 | constants.UPDI_DATA_16,
-                 address & 0xFF, (address >> 8) & 0xFF, (address >> 16) & 0xFF])
+            self.updi_phy.send(_HDR_STS24_16 + address.to_bytes(3, "little"))
         else:
-            self.updi_phy.send(
-                [constants.UPDI_PHY_SYNC, constants.UPDI_STS | constants.UPDI_ADDRESS_16 | constants.UPDI_DATA_16,
-                 address & 0xFF, (address >> 8) & 0xFF])
+            self.updi_phy.send(_HDR_STS16_16 + address.to_bytes(2, "little"))
         response = self.updi_phy.receive(1)
         if len(response) != 1 or response[0] != constants.UPDI_PHY_ACK:
             raise Exception("Error with st")
 
-        self.updi_phy.send([value & 0xFF, (value >> 8) & 0xFF])
+        self.updi_phy.send(bytes([value & 0xFF, (value >> 8) & 0xFF]))
         response = self.updi_phy.receive(1)
         if len(response) != 1 or response[0] != constants.UPDI_PHY_ACK:
             raise Exception("Error with st")
 
-    def ld_ptr_inc(self, size):
+    def ld_block(self, address, size):
         """
-            Loads a number of bytes from the pointer location with pointer post-increment
+            Loads a number of bytes from a 16/24-bit address, setting up the pointer in the same transfer
         """
-        self.logger.info("LD8 from ptr++")
-        self.updi_phy.send([constants.UPDI_PHY_SYNC, constants.UPDI_LD | constants.UPDI_PTR_INC |
-                            constants.UPDI_DATA_8])
-        return self.updi_phy.receive(size)
+        response = bytearray(size)
+        count = self.ld_block_into(address, response)
+        if count != size:
+            del response[count:]
+        return response
 
-    def ld_ptr_inc16(self, words):
+    def ld_block_into(self, address, buffer, use_word_access=False):
         """
-            Load a 16-bit word value from the pointer location with pointer post-increment
+            Loads bytes or words from a 16/24-bit address into a buffer, setting up the pointer in the same transfer
+            Acks are disabled while the pointer is stored, so only the echo and the data come back
+            Returns the number of bytes received
         """
-        self.logger.info("LD16 from ptr++")
-        self.updi_phy.send([constants.UPDI_PHY_SYNC, constants.UPDI_LD | constants.UPDI_PTR_INC |
-                            constants.UPDI_DATA_16])
-        return self.updi_phy.receive(words << 1)
+        self.logger.info("LD block from 0x%06X", address)
+        frame = bytearray(_FRAME_ACKOFF)
+        if self.use24bit:
+            frame += _HDR_ST_PTR_ADDR_24
+            frame += address.to_bytes(3, "little")
+        else:
+            frame += _HDR_ST_PTR_ADDR_16
+            frame += address.to_bytes(2, "little")
+        count = len(buffer) >> 1 if use_word_access else len(buffer)
+        if count > 1:
+            frame += _repeat_frame(count)
+        # The load has to close the frame: the device answers straight away
+        frame += _HDR_LD_PTRINC_16 if use_word_access else _HDR_LD_PTRINC_8
+        self.updi_phy.send(frame)
+        received = self.updi_phy.receive_into(buffer)
+
+        # Re-enable acks
+        self.stcs(constants.UPDI_CS_CTRLA, _CTRLA_ACKON)
+        return received
 
-    def st_ptr(self, address):
+    def st_block(self, address, data, use_word_access=True, before=(), after=()):
         """
-            Set the pointer location
+            Stores a block of data from the given address as one transfer
+            Optional (address, value) byte stores are made before and after the block,
+            e.g. NVM commands. Acks are disabled throughout, so only the echo comes back.
         """
-        self.logger.info("ST to ptr")
+        self.logger.info("ST block to 0x%06X", address)
+        # The repeat would otherwise swallow whatever follows the block as data
+        if len(data) == 0:
+            raise Exception("No data to store!")
         if self.use24bit:
-            self.updi_phy.send(
-                [constants.UPDI_PHY_SYNC, constants.UPDI_ST | constants.UPDI_PTR_ADDRESS | constants.UPDI_DATA_24,
-                 address & 0xFF, (address >> 8) & 0xFF, (address >> 16) & 0xFF])
+            ptr_header = _HDR_ST_PTR_ADDR_24
+            address_size = 3
         else:
-            self.updi_phy.send(
-                [constants.UPDI_PHY_SYNC, constants.UPDI_ST | constants.UPDI_PTR_ADDRESS | constants.UPDI_DATA_16,
-                address & 0xFF, (address >> 8) & 0xFF])
-        response = self.updi_phy.receive(1)
-        if len(response) != 1 or response[0] != constants.UPDI_PHY_ACK:
-            raise Exception("Error with st_ptr")
+            ptr_header = _HDR_ST_PTR_ADDR_16
+            address_size = 2
+
+        frame = bytearray(_FRAME_ACKOFF)
+        for st_address, value in before:
+            self._add_sts_frame(frame, st_address, value)
+        frame += ptr_header
+        frame += address.to_bytes(address_size, "little")
+        if use_word_access:
+            frame += _repeat_frame(len(data) >> 1)
+            frame += _HDR_ST_PTRINC_16
+        else:
+            frame += _repeat_frame(len(data))
+            frame += _HDR_ST_PTRINC_8
+        frame.extend(data)
+        for st_address, value in after:
+            self._add_sts_frame(frame, st_address, value)
+        frame += _FRAME_ACKON
+        self.updi_phy.send(frame)
 
-    def st_ptr_inc(self, data):
+    def st_noack(self, address, value):
         """
-            Store data to the pointer location with pointer post-increment
+            Store a single byte value directly to a 16/24-bit address as one transfer
+            Acks are disabled around it, so only the echo comes back. Any failure has
+            to be picked up by reading back status afterwards.
         """
-        self.logger.info("ST8 to *ptr++")
-        self.updi_phy.send([constants.UPDI_PHY_SYNC, constants.UPDI_ST | constants.UPDI_PTR_INC | constants.UPDI_DATA_8,
-                            data[0]])
-        response = self.updi_phy.receive(1)
-
-        if len(response) != 1 or response[0] != constants.UPDI_PHY_ACK:
-            raise Exception("ACK error with st_ptr_inc")
-
-        n = 1
-        while n < len(data):
-            self.updi_phy.send([data[n]])
-            response = self.updi_phy.receive(1)
-
-            if len(response) != 1 or response[0] != constants.UPDI_PHY_ACK:
-                raise Exception("Error with st_ptr_inc")
-            n += 1
-
-    def st_ptr_inc16(self, data):
-        """
-            Store a 16-bit word value to the pointer location with pointer post-increment
-    
-            Disable acks when we do this, to reduce latency.
-        """
-        self.logger.info("ST16 to *ptr++")
-        ctrla_ackon = 1 << constants.UPDI_CTRLA_IBDLY_BIT # with acks enabled.
-        ctrla_ackoff = ctrla_ackon | (1 << constants.UPDI_CTRLA_RSD_BIT) # acks off. (RSD)
-        # (Response signature disable)
-        self.stcs(constants.UPDI_CS_CTRLA, ctrla_ackoff)
-        self.updi_phy.send([constants.UPDI_PHY_SYNC, constants.UPDI_ST | constants.UPDI_PTR_INC |
-                            constants.UPDI_DATA_16] )
-        self.updi_phy.send(data) # No response expected.
-        # Re-enable acks
-        self.stcs(constants.UPDI_CS_CTRLA, ctrla_ackon)
+        self.logger.info("ST to 0x%06X without ack", address)
+        frame = bytearray(_FRAME_ACKOFF)
+        self._add_sts_frame(frame, address, value)
+        frame += _FRAME_ACKON
+        self.updi_phy.send(frame)
 
-
-    def repeat(self, repeats):
+    def _add_sts_frame(self, frame, address, value):
         """
-            Store a value to the repeat counter
+            Appends a single byte STS to a 16/24-bit address onto a frame
         """
-        if (repeats - 1) > constants.UPDI_MAX_REPEAT_SIZE:
-            raise Exception("Invalid repeat count!")
-        self.logger.info("Repeat {0:d}".format(repeats))
-        repeats -= 1
-        self.updi_phy.send([constants.UPDI_PHY_SYNC, constants.UPDI_REPEAT | constants.UPDI_REPEAT_BYTE,
-                            repeats & 0xFF])
+        if self.use24bit:
+            frame += _HDR_STS24_8
+            frame += address.to_bytes(3, "little")
+        else:
+            frame += _HDR_STS16_8
+            frame += address.to_bytes(2, "little")
+        frame.append(value & 0xFF)
 
     def read_sib(self):
         """
@@ -243,5 +337,6 @@ class UpdiDatalink(object):
         self.logger.info("Writing key")
         if len(key) != 8 << size:
             raise Exception("Invalid KEY length!")
-        self.updi_phy.send([constants.UPDI_PHY_SYNC, constants.UPDI_KEY | constants.UPDI_KEY_KEY | size])
-        self.updi_phy.send(list(reversed(list(key))))
+        # No response comes between the header and the key, so they go out as one transfer
+        self.updi_phy.send(bytes([constants.UPDI_PHY_SYNC, constants.UPDI_KEY | constants.UPDI_KEY_KEY | size]) +
+                           bytes(key)[::-1])
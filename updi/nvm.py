@@ -3,6 +3,8 @@
 """
 import logging
 
+from intelhex import IntelHex
+
 from updi.application import UpdiApplication
 import updi.constants as constants
 
@@ -19,6 +21,13 @@ class UpdiNvmProgrammer(object):
         self.progmode = False
         self.logger = logging.getLogger("nvm")
 
+    def try_baud(self, bauds):
+        """
+            Switches to the first of the given bauds that works, returning the baud in use
+        """
+        self.logger.info("Probing bauds %s", bauds)
+        return self.application.datalink.try_baud(bauds)
+
     def get_device_info(self):
         """
             Reads device info
@@ -26,6 +35,12 @@ class UpdiNvmProgrammer(object):
         self.logger.info("Reading device info")
         return self.application.device_info()
 
+    def is_locked(self):
+        """
+            Checks whether the device is locked
+        """
+        return self.application.is_locked()
+
     def enter_progmode(self):
         """
             Enter programming mode
@@ -56,14 +71,14 @@ class UpdiNvmProgrammer(object):
         # Unlock after using the NVM key results in prog mode.
         self.progmode = True
 
-    def chip_erase(self):
+    def chip_erase(self, wait=True):
         """
             Erase (unlocked) device
         """
         if not self.progmode:
             raise Exception("Enter progmode first!")
 
-        return self.application.chip_erase()
+        return self.application.chip_erase(wait=wait)
 
     def eeprom_erase(self):
         if not self.progmode:
@@ -88,20 +103,27 @@ class UpdiNvmProgrammer(object):
         if not self.progmode:
             raise Exception("Enter progmode first!")
 
-        # Find the number of pages
-        pages = size // pagesize
+        # Only whole pages are read
         if size % pagesize:
             raise Exception("Only full page aligned flash supported.")
 
-        data = []
-        # Read out page-wise for convenience
-        for _ in range(pages):
-            self.logger.info("Reading page at 0x{0:04X}".format(address))
-            if use_word_access:
-                data += (self.application.read_data_words(address, pagesize >> 1))
-            else:
-                data += (self.application.read_data(address, pagesize))
-            address += pagesize
+        if use_word_access:
+            read_into = self.application.read_data_words_into
+            max_block = constants.UPDI_MAX_REPEAT_SIZE << 1
+        else:
+            read_into = self.application.read_data_into
+            max_block = constants.UPDI_MAX_REPEAT_SIZE
+
+        # Read as many whole pages at a time as one repeat allows, straight into the result
+        blocksize = max(pagesize, max_block - max_block % pagesize)
+        data = bytearray(size)
+        with memoryview(data) as view:
+            for offset in range(0, size, blocksize):
+                block = view[offset:offset + blocksize]
+                self.logger.debug("Reading %d bytes at 0x%04X", len(block), address)
+                if read_into(address, block) != len(block):
+                    raise Exception("Timeout reading at 0x{0:04X}".format(address))
+                address += len(block)
         return data
 
     def write_flash(self, address, data):
@@ -127,11 +149,8 @@ class UpdiNvmProgrammer(object):
         # Divide up into pages
         pages = self.page_data(data, pagesize)
 
-        # Program each page
-        for page in pages:
-            self.logger.info("Writing page at 0x{0:04X}".format(address))
-            self.application.write_nvm(address, page, use_word_access=use_word_access)
-            address += len(page)
+        # Program all pages
+        self.application.write_nvm_pages(address, pages, use_word_access=use_word_access)
 
     def read_fuse(self, fusenum):
         """
@@ -145,6 +164,17 @@ class UpdiNvmProgrammer(object):
         data = self.application.datalink.ld(address)
         return data
 
+    def read_fuses(self, count):
+        """
+            Reads a number of consecutive fuse values, starting from fuse 0
+        """
+        # Must be in prog mode
+        if not self.progmode:
+            raise Exception("Enter progmode first!")
+
+        # One REPEAT'd read rather than a transaction per fuse
+        return self.application.read_data(self.device.fuses_address, count)
+
     def write_fuse(self, fusenum, value):
         """
             Writes one fuse value
@@ -165,23 +195,21 @@ class UpdiNvmProgrammer(object):
             Pads data so that there are full pages
         """
         self.logger.info("Padding to blocksize {0:d} with 0x{1:X}".format(blocksize, character))
-        if len(data) % blocksize > 0:
-            for _ in range(len(data) % blocksize, blocksize):
-                data.append(0)
+        # Padding is done in place, so the caller's buffer is full pages too
+        padding = -len(data) % blocksize
+        if padding:
+            data.extend([character] * padding)
         return data
 
     def page_data(self, data, size):
         """
             Divide data into pages
+            Pages are yielded one at a time as views into data, so nothing is copied
         """
         self.logger.info("Paging into {} byte blocks".format(size))
-        total_length = len(data)
-        result = []
-
-        while len(result) < total_length / size:
-            result.append(data[:size].tolist())
-            data = data[size:]
-        return result
+        with memoryview(data) as view:
+            for offset in range(0, len(view), size):
+                yield view[offset:offset + size]
 
     def load_ihex_flash(self, filename):
         return self._load_ihex(filename, self.device.flash_size, self.device.flash_start)
@@ -194,7 +222,6 @@ class UpdiNvmProgrammer(object):
             Load from intel hex format
         """
         self.logger.info("Loading from hexfile '{}'".format(filename))
-        from intelhex import IntelHex
 
         ih = IntelHex()
         ih.loadhex(filename)
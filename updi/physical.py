@@ -1,12 +1,20 @@
 """
     Serial driver for UPDI stack
 """
+import array
 import logging
-import time
+import os
+import sys
 import serial
 
 import updi.constants as constants
 
+# Linux tty flag from <linux/tty_flags.h>
+ASYNC_LOW_LATENCY = 0x2000
+
+# SIB request frame, which is the same on every call
+_SIB_CMD = bytes([constants.UPDI_PHY_SYNC, constants.UPDI_KEY | constants.UPDI_KEY_SIB | constants.UPDI_SIB_16BYTES])
+
 
 class UpdiPhysical(object):
     """
@@ -24,22 +32,85 @@ class UpdiPhysical(object):
         self.ser = None
         self.initialise_serial(self.port, self.baud)
         # send an initial break as handshake
-        self.send([constants.UPDI_BREAK])
+        self.send(bytes([constants.UPDI_BREAK]))
 
     def initialise_serial(self, port, baud):
         """
             Standard COM port initialisation
         """
-        self.logger.info("Opening {} at {} baud".format(port, baud))
-        self.ser = serial.Serial(port, baud, parity=serial.PARITY_EVEN, timeout=1, stopbits=serial.STOPBITS_TWO)
+        self.logger.info("Opening %s at %d baud", port, baud)
+        # A stalled adapter raises on write instead of hanging the session
+        self.ser = serial.Serial(port, baud, parity=serial.PARITY_EVEN, timeout=1, write_timeout=1,
+                                 stopbits=serial.STOPBITS_TWO)
+        self._set_low_latency()
+        self._set_latency_timer()
+
+    def _set_low_latency(self):
+        """
+            Asks the driver to deliver received bytes without delay (Linux ASYNC_LOW_LATENCY).
+            Not all platforms and adapters support this, so failure is not an error.
+        """
+        try:
+            self.ser.set_low_latency_mode(True)
+        except AttributeError:
+            # pyserial before 3.5 has no helper, so set the flag directly
+            self._ioctl_low_latency()
+        except (NotImplementedError, ValueError, IOError):
+            self.logger.info("Low latency mode not available on '%s'", self.port)
+
+    def _ioctl_low_latency(self):
+        """
+            Sets ASYNC_LOW_LATENCY through TIOCGSERIAL/TIOCSSERIAL, as newer pyserial does
+        """
+        try:
+            import fcntl
+            import termios
+            serial_struct = array.array('i', [0] * 32)
+            fcntl.ioctl(self.ser.fileno(), termios.TIOCGSERIAL, serial_struct)
+            # flags field of struct serial_struct
+            serial_struct[4] |= ASYNC_LOW_LATENCY
+            fcntl.ioctl(self.ser.fileno(), termios.TIOCSSERIAL, serial_struct)
+        except (ImportError, AttributeError, IOError):
+            self.logger.info("Low latency mode not available on '%s'", self.port)
+
+    def _set_latency_timer(self):
+        """
+            Lowers the USB latency timer of FTDI-style adapters from the default 16ms to 1ms (Linux sysfs).
+            The timer is paid on every read round-trip. Non-FTDI adapters and
+            read-only sysfs are not an error.
+        """
+        if not sys.platform.startswith("linux"):
+            return
+        tty = os.path.basename(os.path.realpath(self.port))
+        try:
+            with open("/sys/bus/usb-serial/devices/{}/latency_timer".format(tty), "w") as latency_timer:
+                latency_timer.write("1")
+        except IOError:
+            self.logger.info("USB latency timer not adjustable on '%s'", self.port)
+
+    def set_baud(self, baud):
+        """
+            Re-configures the open port to a different baud
+        """
+        self.logger.info("Switching to %d baud", baud)
+        self.baud = baud
+        self.ser.baudrate = baud
+
+    def set_timeout(self, timeout):
+        """
+            Changes the read timeout of the open port (seconds)
+            Returns the previous timeout, so it can be restored
+        """
+        previous = self.ser.timeout
+        self.ser.timeout = timeout
+        return previous
 
     def _loginfo(self, msg, data):
-        if data and isinstance(data[0], str):
-            i_data = [ord(x) for x in data]
-        else:
-            i_data = data
-        data_str = "[" + ", ".join([hex(x) for x in i_data]) + "]"
-        self.logger.info(msg + ' : ' + data_str)
+        # Formatting every byte is costly, so skip it when nothing would be logged
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        data_str = "[" + ", ".join([hex(x) for x in data]) + "]"
+        self.logger.info("%s : %s", msg, data_str)
 
     def send_double_break(self):
         """
@@ -51,66 +122,70 @@ class UpdiPhysical(object):
 
         self.logger.info("Sending double break")
 
-        # Re-init at a lower baud
+        # Re-configure at a lower baud
         # At 300 bauds, the break character will pull the line low for 30ms
         # Which is slightly above the recommended 24.6ms
-        self.ser.close()
-
-        temporary_serial = serial.Serial(self.port, 300, stopbits=serial.STOPBITS_ONE, timeout=1)
+        # The open port is re-configured in place, which is much quicker than re-opening it
+        self.ser.baudrate = 300
+        self.ser.parity = serial.PARITY_NONE
+        self.ser.stopbits = serial.STOPBITS_ONE
 
         # Send two break characters, with 1 stop bit in between
-        temporary_serial.write([constants.UPDI_BREAK, constants.UPDI_BREAK])
+        self.ser.write(bytes([constants.UPDI_BREAK, constants.UPDI_BREAK]))
 
         # Wait for the double break end
-        temporary_serial.read(2)
+        self.ser.read(2)
 
-        # Re-init at the real baud
-        temporary_serial.close()
-        self.initialise_serial(self.port, self.baud)
+        # Back to the real baud and framing
+        self.ser.baudrate = self.baud
+        self.ser.parity = serial.PARITY_EVEN
+        self.ser.stopbits = serial.STOPBITS_TWO
+        self.ser.reset_input_buffer()
 
     def send(self, command):
         """
-            Sends a char array to UPDI with NO inter-byte delay
+            Sends a bytes frame to UPDI with NO inter-byte delay
             Note that the byte will echo back
         """
         self.logger.info("send %d bytes", len(command))
         self._loginfo("data: ", command)
 
+        # One write for the whole frame, then drain the echo in one read
         self.ser.write(command)
         # it will echo back.
         echo = self.ser.read(len(command))
+        if len(echo) != len(command):
+            self.logger.error("Echo incomplete: sent %d bytes, got %d back", len(command), len(echo))
 
     def receive(self, size):
         """
             Receives a frame of a known number of chars from UPDI
         """
-        response = bytearray()
-        timeout = 1
-
-        # For each byte
-        while size and timeout:
-
-            # Read
-            character = self.ser.read()
+        # Read straight into the response buffer, trimming it if the port timed out short
+        response = bytearray(size)
+        count = self.receive_into(response)
+        if count != size:
+            del response[count:]
+        return response
 
-            # Anything in?
-            if character:
-                response.append(ord(character))
-                size -= 1
-            else:
-                timeout -= 1
+    def receive_into(self, buffer):
+        """
+            Receives a frame of a known number of chars from UPDI into a given buffer
+            Returns the number of chars actually received
+        """
+        # A single read returns as soon as all chars are in, or when the port times out
+        count = self.ser.readinto(buffer)
 
-        self._loginfo("receive", response)
-        return response
+        self._loginfo("receive", buffer[:count])
+        return count
 
     def sib(self):
         """
             System information block is just a string coming back from a SIB command
         """
-        self.send([
-            constants.UPDI_PHY_SYNC,
-            constants.UPDI_KEY | constants.UPDI_KEY_SIB | constants.UPDI_SIB_16BYTES])
-        return self.ser.readline()
+        self.send(_SIB_CMD)
+        # The SIB is not line terminated, so read its exact size rather than waiting for the timeout
+        return self.ser.read(8 << constants.UPDI_SIB_16BYTES)
 
     def __del__(self):
         if self.ser:
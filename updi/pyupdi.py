@@ -7,8 +7,7 @@ import argparse
 import re
 import logging
 
-from device.device import Device
-from updi.nvm import UpdiNvmProgrammer
+from device.device import Device, get_device
 """
 Copyright (c) 2016 Atmel Corporation, a wholly owned subsidiary of Microchip Technology Inc.
 
@@ -54,6 +53,17 @@ pyupdi is a Python utility for programming AVR devices with UPDI interface
 """
 
 
+# Baud used when none is given, and the faster ones tried with "-b auto" before bulk transfers
+_DEFAULT_BAUD = 115200
+_PROBE_BAUDS = (460800, 230400)
+
+# Fuse argument syntax: fuse_nr:0xvalue
+_FUSE_RE = re.compile(r"^([0-9]+):0x([0-9a-fA-F]+)$")
+
+# Verify mismatches listed before the rest are only counted
+_VERIFY_ERRORS_SHOWN = 16
+
+
 def _main():
     if sys.version_info[0] < 3:
         print("WARNING: for best results use Python3")
@@ -66,7 +76,11 @@ def _main():
                         help="Com port to use (Windows: COMx | *nix: /dev/ttyX)")
     parser.add_argument("-e", "--erase", action="store_true",
                         help="Perform a chip erase (implied with --flash)")
-    parser.add_argument("-b", "--baudrate", type=int, default=115200)
+    parser.add_argument("-b", "--baudrate", type=_baudrate,
+                        help="Baud rate (default: {}), or 'auto' to use the fastest of {} that works "
+                             "for flash/EEPROM writes. 'auto' runs the UPDI clock at 16 MHz, which the "
+                             "datasheets only recommend with BOD at its highest level".format(
+                                 _DEFAULT_BAUD, "/".join(str(baud) for baud in _PROBE_BAUDS)))
     parser.add_argument("-f", "--flash", help="Intel HEX file to flash.")
     parser.add_argument("-r", "--reset", action="store_true",
                         help="Reset")
@@ -94,17 +108,25 @@ def _main():
         logging.basicConfig(format="%(levelname)s:%(name)s %(message)s",
                             level=logging.WARNING)
 
+    # The UPDI stack pulls in pyserial and intelhex, so it is only loaded once there is work to do
+    from updi.nvm import UpdiNvmProgrammer
+
+    probe_baud = args.baudrate == "auto"
     nvm = UpdiNvmProgrammer(comport=args.comport,
-                            baud=args.baudrate,
-                            device=Device(args.device))
+                            baud=_DEFAULT_BAUD if probe_baud or args.baudrate is None else args.baudrate,
+                            device=get_device(args.device))
+    if probe_baud and (args.flash or args.eeprom):
+        # Bulk transfers are worth a faster link, if the device keeps up
+        nvm.try_baud(_PROBE_BAUDS)
     if not args.reset: # any action except reset
         # Reteieve info before building the stack to be sure its the correct device
         nvm.get_device_info()
-        try:
-            nvm.enter_progmode()
-        except:
+        # Locked devices can't enter programming mode, so check up front rather than waiting for it to fail
+        if nvm.is_locked():
             print("Device is locked. Performing unlock with chip erase.")
             nvm.unlock_device()
+        else:
+            nvm.enter_progmode()
 
         print("Device info: {0:s}".format(str(nvm.get_device_info())))
 
@@ -115,25 +137,38 @@ def _main():
     nvm.leave_progmode()
 
 
+def _baudrate(value):
+    """
+        Parses the baud rate argument: a number, or "auto"
+    """
+    if value == "auto":
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a number or 'auto', got '{}'".format(value))
+
+
 def _process(nvm, args):
     if args.erase:
         try:
             nvm.chip_erase()
-        except:
+        except Exception as error:
+            print("Chip erase failed: {}".format(error))
             return False
     if args.fuses is not None:
+        fuses = {}
         for fslist in args.fuses:
             for fsarg in fslist:
-                if not re.match("^[0-9]+:0x[0-9a-fA-F]+$", fsarg):
+                match = _FUSE_RE.match(fsarg)
+                if not match:
                     print("Bad fuses format {}. Expected fuse_nr:0xvalue".format(fsarg))
                     continue
-                lst = fsarg.split(":0x")
-                fusenum = int(lst[0])
-                value = int(lst[1], 16)
-                if not _set_fuse(nvm, fusenum, value):
-                    return False
+                fuses[int(match.group(1))] = int(match.group(2), 16)
+        if fuses and not _set_fuses(nvm, fuses):
+            return False
     if args.flash is not None:
-        return _flash_file(nvm, args.flash)
+        return _flash_file(nvm, args.flash, skip_erase=args.erase)
     if args.eeprom is not None:
         return _write_eeprom(nvm, args.eeprom)
     if args.readfuses:
@@ -142,61 +177,107 @@ def _process(nvm, args):
     return True
 
 
-def _flash_file(nvm, filename):
+def _flash_file(nvm, filename, skip_erase=False):
+    # Parse and size check the file before touching the device, so bad input never erases it
     data, start_address = nvm.load_ihex_flash(filename)
 
-    fail = False
+    # The erase is skipped when the chip has just been erased already
+    # Otherwise it is not waited for here; the first page write waits for it to finish
+    if not skip_erase:
+        nvm.chip_erase(wait=False)
 
-    nvm.chip_erase()
     nvm.write_flash(start_address, data)
 
     # Read out again
-    readback = nvm.read_flash(start_address, len(data))
-    for i, _ in enumerate(data):
-        if data[i] != readback[i]:
-            print("Verify error at location 0x{0:04X}: expected 0x{1:02X} read 0x{2:02X} ".format(i, data[i],
-                                                                                                  readback[i]))
-            fail = True
+    fail = not _verify_flash(nvm, start_address, data)
 
     if not fail:
         print("Programming successful")
     return not fail
 
 
-def _set_fuse(nvm, fusenum, value):
-    nvm.write_fuse(fusenum, value)
-    actual_val = nvm.read_fuse(fusenum)
-    ret = actual_val == value
-    if not ret:
-        print("Verify error for fuse {0}, expected 0x{1:02X} read 0x{2:02X}".format(fusenum, value, actual_val))
-    else:
-        print("Fuse {0} set to 0x{1:02X} successfully".format(fusenum, value))
+def _verify_flash(nvm, start_address, data):
+    """
+        Reads back and verifies the pages of a flash image which hold data
+        Blank pages are skipped, as the chip erase has left them blank already
+    """
+    pagesize = nvm.device.flash_pagesize
+    blank = bytes([0xFF]) * pagesize
+    ok = True
+    with memoryview(data) as view:
+        # Group the non-blank pages into runs, so each run is read back in one go
+        runs = []
+        for offset in range(0, len(view), pagesize):
+            if view[offset:offset + pagesize] == blank:
+                continue
+            if runs and runs[-1][0] + runs[-1][1] == offset:
+                runs[-1][1] += pagesize
+            else:
+                runs.append([offset, pagesize])
+
+        for offset, size in runs:
+            readback = nvm.read_flash(start_address + offset, size)
+            if not _verify(view[offset:offset + size], readback, offset):
+                ok = False
+    return ok
+
+
+def _verify(data, readback, offset=0):
+    """
+        Compares written data against its readback, reporting any mismatches
+    """
+    data = bytes(data)
+    readback = bytes(readback)
+    # Whole-buffer compare first, only walk the bytes when something differs
+    if data == readback:
+        return True
+
+    # A bad readback can differ everywhere, so only the first few errors are listed, in one print
+    errors = [(i, expected, actual) for i, (expected, actual) in enumerate(zip(data, readback), offset)
+              if expected != actual]
+    report = ["Verify error at location 0x{0:04X}: expected 0x{1:02X} read 0x{2:02X} ".format(*error)
+              for error in errors[:_VERIFY_ERRORS_SHOWN]]
+    if len(errors) > _VERIFY_ERRORS_SHOWN:
+        report.append("... and {0:d} more verify errors".format(len(errors) - _VERIFY_ERRORS_SHOWN))
+    print("\n".join(report))
+    return False
+
+
+def _set_fuses(nvm, fuses):
+    for fusenum, value in fuses.items():
+        nvm.write_fuse(fusenum, value)
+
+    # Verify them all with one read of the fuses, rather than a read per fuse
+    fusevals = nvm.read_fuses(max(fuses) + 1)
+    ret = True
+    for fusenum, value in fuses.items():
+        actual_val = fusevals[fusenum]
+        if actual_val != value:
+            print("Verify error for fuse {0}, expected 0x{1:02X} read 0x{2:02X}".format(fusenum, value, actual_val))
+            ret = False
+        else:
+            print("Fuse {0} set to 0x{1:02X} successfully".format(fusenum, value))
     return ret
 
 
 def _read_fuses(nvm):
-    print("Fuse:Value")
-    for fusenum in range (0,11): # This range should probably be defined for each chip
-        fuseval=nvm.read_fuse(fusenum)
-        print("{0}:0x{1:02X}".format(fusenum,fuseval))
+    fusevals = nvm.read_fuses(11) # This count should probably be defined for each chip
+    # Build the whole table and print it in one go
+    lines = ["Fuse:Value"]
+    lines.extend("{0}:0x{1:02X}".format(fusenum, fuseval) for fusenum, fuseval in enumerate(fusevals))
+    print("\n".join(lines))
     return True
 
 
 def _write_eeprom(nvm, filename):
     data, start_address = nvm.load_ihex_eeprom(filename)
 
-    fail = False
-
     nvm.eeprom_erase()
     nvm.write_eeprom(start_address, data)
 
     # Read out again
     readback = nvm.read_eeprom(nvm.device.eeprom_start, len(data))
-    for i, _ in enumerate(data):
-        if data[i] != readback[i]:
-            print("Verify error at location 0x{0:04X}: expected 0x{1:02X} read 0x{2:02X} ".format(i, data[i],
-                                                                                                  readback[i]))
-            fail = True
+    fail = not _verify(data, readback)
 
     if not fail:
         print("EEPROM write successful")
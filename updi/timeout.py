@@ -15,10 +15,11 @@ class Timeout(object):
         """
 
         self.timeout_ms = timeout_ms
-        self.start_time = time.time()
+        # Monotonic, so a wall clock change can't cut the wait short or stretch it
+        self.deadline = time.monotonic() + timeout_ms / 1000.0
 
     def expired(self):
         """
             Check if the timeout has expired
         """
-        return time.time() - self.start_time > self.timeout_ms / 1000.0
+        return time.monotonic() > self.deadline